@@ -1,103 +1,103 @@
+import functools
 import io
-import json
-import logging
 import os
-import sys
-from typing import Dict, Iterable, Tuple
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from string import Template
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-import boto3
 import numpy as np
+import orjson
 import torch
-import watchtower
-from botocore.config import Config
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from PIL import Image
+from torchvision.io import ImageReadMode, decode_jpeg, encode_jpeg
+from turbojpeg import TJPF_RGB, TurboJPEG
+
+from aws_clients import cloudwatch, s3, setup_logging, sqs
 
 
 # Environment variables
-AWS_ENDPOINT_URL = os.environ.get("AWS_ENDPOINT_URL","http://localhost:4566")
-#AWS_ENDPOINT_URL = os.environ.get("AWS_ENDPOINT_URL")
-AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
-AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
 UPLOAD_BUCKET = os.environ.get("UPLOAD_BUCKET", "uploads")
 OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET", "processed")
 UPLOAD_QUEUE_NAME = os.environ.get("UPLOAD_QUEUE_NAME", "upload-events")
 LOG_GROUP_NAME = os.environ.get("CLOUDWATCH_LOG_GROUP", "/local/processor")
 LOG_STREAM_NAME = os.environ.get("CLOUDWATCH_LOG_STREAM", "processor")
 COST_PER_IMAGE = float(os.environ.get("COST_PER_IMAGE_USD", "0.0005"))
+MAX_IMAGE_HEIGHT = int(os.environ.get("MAX_IMAGE_HEIGHT", "4096"))
+MAX_IMAGE_WIDTH = int(os.environ.get("MAX_IMAGE_WIDTH", "4096"))
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", "4"))
+# Each of the three stage queues holds up to PIPELINE_DEPTH received batches, so
+# a message can wait behind that many batches per queue, plus one blocked put
+# per stage, before it is deleted; it must stay invisible that long or SQS hands
+# it out a second time.
+SQS_VISIBILITY_TIMEOUT = int(os.environ.get("SQS_VISIBILITY_TIMEOUT", "300"))
+S3_MAX_WORKERS = int(os.environ.get("S3_MAX_WORKERS", "16"))
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "10"))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "75"))
+# "gpu" sends images of at least CPU_INVERT_MAX_BYTES through the device; "yuv"
+# inverts JPEG uploads in their YCbCr planes on the host with libjpeg-turbo.
+INVERT_BACKEND = os.environ.get("INVERT_BACKEND", "gpu")
+# Smaller decoded images are inverted on the host: for them the H2D and D2H
+# copies cost far more than the kernel saves. Defaults to 16 MiB.
+CPU_INVERT_MAX_BYTES = int(os.environ.get("CPU_INVERT_MAX_BYTES", "16777216"))
+SQS_BATCH_SIZE = 10  # SQS limit for both receive and delete batches
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+JPEG_MAGIC = b"\xff\xd8"
+
+
+LOGGER = setup_logging("processor", LOG_GROUP_NAME, LOG_STREAM_NAME)
+
+# Serialized once at import; only the queue ARN is filled in at startup.
+UPLOAD_QUEUE_POLICY = Template(
+    orjson.dumps(
+        {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Sid": "AllowS3Uploads",
+                    "Effect": "Allow",
+                    "Principal": {"Service": "s3.amazonaws.com"},
+                    "Action": "sqs:SendMessage",
+                    "Resource": "$queue_arn",
+                    "Condition": {
+                        "ArnEquals": {"aws:SourceArn": f"arn:aws:s3:::{UPLOAD_BUCKET}"}
+                    },
+                }
+            ],
+        }
+    ).decode()
+)
+
+
+def allocate_staging_buffer() -> Optional[torch.Tensor]:
+    """Pinned host buffer reused for every host-to-device image copy."""
+
+    if DEVICE.type != "cuda":
+        return None
+    return torch.empty(
+        MAX_IMAGE_HEIGHT * MAX_IMAGE_WIDTH * 3, dtype=torch.uint8, pin_memory=True
+    )
 
 
-def build_common_kwargs() -> Dict[str, str]:
-    """Common configuration for boto3 clients respecting LocalStack endpoints."""
-
-    kwargs: Dict[str, str] = {"region_name": AWS_REGION}
-    if AWS_ENDPOINT_URL:
-        kwargs["endpoint_url"] = AWS_ENDPOINT_URL
-    if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-        kwargs.update(
-            {
-                "aws_access_key_id": AWS_ACCESS_KEY_ID,
-                "aws_secret_access_key": AWS_SECRET_ACCESS_KEY,
-            }
-        )
-    return kwargs
-
-
-COMMON_KWARGS = build_common_kwargs()
-S3_CONFIG = Config(signature_version="s3v4", s3={"addressing_style": "path"})
-
-s3 = boto3.client("s3", config=S3_CONFIG, **COMMON_KWARGS)
-sqs = boto3.client("sqs", **COMMON_KWARGS)
-cloudwatch = boto3.client("cloudwatch", **COMMON_KWARGS)
-logs_client = boto3.client("logs", **COMMON_KWARGS)
-
-
-def setup_logging() -> logging.Logger:
-    """Configure application logging to send output to stdout and CloudWatch."""
-
-    logger = logging.getLogger("processor")
-    logger.setLevel(logging.INFO)
-    if not logger.handlers:
-        stream_handler = logging.StreamHandler(sys.stdout)
-        stream_handler.setFormatter(
-            logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-        )
-        logger.addHandler(stream_handler)
-
-        try:
-            logs_client.create_log_group(logGroupName=LOG_GROUP_NAME)
-        except ClientError as exc:  # group may already exist
-            error_code = exc.response.get("Error", {}).get("Code")
-            if error_code not in {"ResourceAlreadyExistsException"}:
-                logger.warning("Failed to create log group: %s", exc)
-        except Exception as exc:  # LocalStack may not be ready yet
-            logger.warning("CloudWatch logs unavailable: %s", exc)
-
-        try:
-            logger.addHandler(
-                watchtower.CloudWatchLogHandler(
-                    log_group=LOG_GROUP_NAME,
-                    stream_name=LOG_STREAM_NAME,
-                    create_log_group=False,
-                    boto3_client=boto3.client("logs", **COMMON_KWARGS),
-                )
-            )
-        except Exception as exc:
-            logger.warning("Falling back to stdout logging only: %s", exc)
-
-    return logger
-
+PINNED_STAGING = allocate_staging_buffer()
+H2D_STREAM = torch.cuda.Stream() if DEVICE.type == "cuda" else None
+D2H_STREAM = torch.cuda.Stream() if DEVICE.type == "cuda" else None
 
-LOGGER = setup_logging()
+METRICS: Counter = Counter()
+METRICS_LOCK = threading.Lock()
 
 
 def ensure_bucket(name: str) -> None:
     try:
-        s3.head_bucket(Bucket=name)
+        s3().head_bucket(Bucket=name)
     except ClientError:
         LOGGER.info("Creating bucket %s", name)
-        s3.create_bucket(Bucket=name)
+        s3().create_bucket(Bucket=name)
 
 
 def ensure_buckets() -> None:
@@ -109,33 +109,23 @@ def ensure_upload_queue() -> Tuple[str, str]:
     """Create the SQS queue used for S3 notifications."""
 
     LOGGER.info("Ensuring SQS queue %s", UPLOAD_QUEUE_NAME)
-    response = sqs.create_queue(
+    response = sqs().create_queue(
         QueueName=UPLOAD_QUEUE_NAME,
         Attributes={"ReceiveMessageWaitTimeSeconds": "20"},
     )
     queue_url = response["QueueUrl"]
-    attrs = sqs.get_queue_attributes(
+    attrs = sqs().get_queue_attributes(
         QueueUrl=queue_url, AttributeNames=["QueueArn"]
     )
     queue_arn = attrs["Attributes"]["QueueArn"]
 
-    policy = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Sid": "AllowS3Uploads",
-                "Effect": "Allow",
-                "Principal": {"Service": "s3.amazonaws.com"},
-                "Action": "sqs:SendMessage",
-                "Resource": queue_arn,
-                "Condition": {
-                    "ArnEquals": {"aws:SourceArn": f"arn:aws:s3:::{UPLOAD_BUCKET}"}
-                },
-            }
-        ],
-    }
-    sqs.set_queue_attributes(
-        QueueUrl=queue_url, Attributes={"Policy": json.dumps(policy)}
+    sqs().set_queue_attributes(
+        QueueUrl=queue_url,
+        Attributes={
+            "Policy": UPLOAD_QUEUE_POLICY.substitute(queue_arn=queue_arn),
+            # Set here rather than in create_queue so existing queues pick it up.
+            "VisibilityTimeout": str(SQS_VISIBILITY_TIMEOUT),
+        },
     )
     return queue_url, queue_arn
 
@@ -155,7 +145,7 @@ def configure_upload_bucket_notifications(queue_arn: str) -> None:
             }
         ]
     }
-    s3.put_bucket_notification_configuration(
+    s3().put_bucket_notification_configuration(
         Bucket=UPLOAD_BUCKET,
         NotificationConfiguration=notification_configuration,
     )
@@ -168,89 +158,466 @@ def ensure_infrastructure() -> str:
     return queue_url
 
 
-def read_messages(queue_url: str) -> Iterable[Dict[str, str]]:
+def read_batches(queue_url: str) -> Iterable[List[Dict[str, str]]]:
+    """Yield the messages of each non-empty receive_message response together."""
+
     while True:
-        response = sqs.receive_message(
+        response = sqs().receive_message(
             QueueUrl=queue_url,
-            MaxNumberOfMessages=5,
+            MaxNumberOfMessages=SQS_BATCH_SIZE,
             WaitTimeSeconds=20,
         )
-        for message in response.get("Messages", []):
-            yield message
+        messages = response.get("Messages", [])
+        if messages:
+            yield messages
 
 
 def parse_s3_records(message_body: str) -> Iterable[Dict[str, Dict[str, str]]]:
     try:
-        payload = json.loads(message_body)
-    except json.JSONDecodeError:
+        payload = orjson.loads(message_body)
+    except orjson.JSONDecodeError:
         LOGGER.warning("Skipping non-JSON SQS message: %s", message_body)
         return []
+    if not isinstance(payload, dict):
+        LOGGER.warning("Skipping non-object SQS message: %s", message_body)
+        return []
 
     records = payload.get("Records", [])
     if not records and "Message" in payload:
         try:
-            nested = json.loads(payload["Message"])
-        except json.JSONDecodeError:
+            nested = orjson.loads(payload["Message"])
+        except orjson.JSONDecodeError:
             LOGGER.warning("Nested message payload not JSON: %s", payload["Message"])
             return []
+        if not isinstance(nested, dict):
+            LOGGER.warning("Nested message payload not an object: %s", nested)
+            return []
         records = nested.get("Records", [])
-    return records
+    return [record for record in records if isinstance(record, dict)]
+
+
+def stage_batch(images: List[torch.Tensor]) -> torch.Tensor:
+    """Pack host images back to back into one flat uint8 host tensor."""
+
+    numel = sum(image.numel() for image in images)
+    if numel <= PINNED_STAGING.numel():
+        # The previous transfer must finish before the staging buffer is reused.
+        H2D_STREAM.synchronize()
+        batch = PINNED_STAGING[:numel]
+    else:
+        batch = torch.empty(numel, dtype=torch.uint8, pin_memory=True)
+
+    offset = 0
+    for image in images:
+        batch[offset : offset + image.numel()].view(image.shape).copy_(image)
+        offset += image.numel()
+    return batch
+
+
+def to_device(batch: torch.Tensor) -> torch.Tensor:
+    """Copy a pinned host batch to DEVICE on H2D_STREAM."""
+
+    with torch.cuda.stream(H2D_STREAM):
+        tensor = batch.to(DEVICE, non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record(H2D_STREAM)
+    torch.cuda.current_stream().wait_event(copied)
+    tensor.record_stream(torch.cuda.current_stream())
+    return tensor
+
+
+def process_batch(
+    images: List[torch.Tensor],
+) -> Tuple[List[torch.Tensor], torch.cuda.Event]:
+    """Invert a batch of CHW images with a single kernel launch.
+
+    Images decoded on the host are staged and copied to the device together;
+    images nvJPEG already decoded on the device are packed alongside them
+    without a round-trip. Returns one host view per input image together with
+    the event that marks the end of the device-to-host copy; callers must wait
+    on it before reading the pixels.
+    """
+
+    # Without CUDA, download_image inverts every image on the host instead.
+    assert DEVICE.type == "cuda", DEVICE
+    host_images = [image for image in images if image.device.type == "cpu"]
+    staged = to_device(stage_batch(host_images)) if host_images else None
+    if len(host_images) == len(images):
+        flat = staged
+    else:
+        parts = []
+        offset = 0
+        for image in images:
+            if image.device.type == "cpu":
+                parts.append(staged[offset : offset + image.numel()])
+                offset += image.numel()
+            else:
+                parts.append(image.reshape(-1))
+        flat = torch.cat(parts)
+
+    # ~x == 255 - x only for uint8: the invert stays one byte per pixel with no
+    # integer promotion, and in place it needs no second device buffer.
+    assert flat.dtype == torch.uint8, flat.dtype
+    inverted = flat.bitwise_not_()
+    # Uploads still read the previous batch's buffer, so each batch takes a fresh
+    # one from the caching pinned host allocator instead of sharing.
+    host = torch.empty_like(inverted, device="cpu", pin_memory=True)
+    computed = torch.cuda.Event()
+    computed.record(torch.cuda.current_stream())
+    D2H_STREAM.wait_event(computed)
+    with torch.cuda.stream(D2H_STREAM):
+        host.copy_(inverted, non_blocking=True)
+        done = torch.cuda.Event()
+        done.record(D2H_STREAM)
+    inverted.record_stream(D2H_STREAM)
+
+    results = []
+    offset = 0
+    for image in images:
+        results.append(host[offset : offset + image.numel()].view(image.shape))
+        offset += image.numel()
+    return results, done
+
+
+def extract_keys(message: Dict[str, str]) -> List[str]:
+    keys = []
+    for record in parse_s3_records(message.get("Body", "")):
+        key = record.get("s3", {}).get("object", {}).get("key")
+        if key:
+            keys.append(key)
+    return keys
+
+
+def decode_image(data: bytes) -> torch.Tensor:
+    """Decode to a CHW uint8 tensor, using nvJPEG on the device for JPEGs."""
+
+    if data[:2] == JPEG_MAGIC:
+        try:
+            return decode_jpeg(
+                torch.frombuffer(data, dtype=torch.uint8),
+                mode=ImageReadMode.RGB,
+                device=DEVICE,
+            )
+        except RuntimeError as exc:  # e.g. CMYK JPEGs nvJPEG rejects
+            LOGGER.warning("Falling back to PIL decode: %s", exc)
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    return torch.from_numpy(np.asarray(img)).permute(2, 0, 1)
 
 
-def process_image(key: str) -> None:
-    LOGGER.info("Processing image %s", key)
-    obj = s3.get_object(Bucket=UPLOAD_BUCKET, Key=key)
-    img = Image.open(obj["Body"]).convert("RGB")
-    arr = np.array(img)
-    #tensor = torch.tensor(arr, device="cuda")
-    tensor = torch.tensor(arr, device="cpu")
-    inverted = 255 - tensor
-    result = Image.fromarray(inverted.to("cpu").numpy().astype("uint8"))
+@functools.cache
+def turbo_jpeg() -> Optional[TurboJPEG]:
+    """libjpeg-turbo codec, or None so the host path can fall back to PIL."""
+
+    try:
+        return TurboJPEG()
+    except (OSError, RuntimeError) as exc:  # library missing or too old/new
+        LOGGER.warning("libjpeg-turbo unavailable, using PIL instead: %s", exc)
+        return None
+
+
+def invert_jpeg_yuv(data: bytes) -> bytes:
+    """Invert a JPEG in its decoded YCbCr planes, skipping RGB entirely.
+
+    Inverting RGB maps Y to 255 - Y and each chroma plane to 256 - C, so one
+    bitwise_not over the planar buffer inverts the image to within one chroma
+    level, and libjpeg-turbo re-encodes it with the original subsampling.
+    """
+
+    codec = turbo_jpeg()
+    width, height, subsample = codec.decode_header(data)[:3]
+    planes, _ = codec.decode_to_yuv(data)
+    np.bitwise_not(planes, out=planes)
+    return codec.encode_from_yuv(
+        planes, height, width, quality=JPEG_QUALITY, jpeg_subsample=subsample
+    )
+
+
+def invert_on_host(data: bytes, img: Image.Image) -> bytes:
+    """Invert with NumPy's SIMD bitwise_not; faster than a PCIe round-trip.
 
+    When libjpeg-turbo is available, JPEGs are decoded and everything is
+    encoded by it straight from and into NumPy buffers; ``img`` is only decoded
+    for other formats. Without it, PIL does both.
+    """
+
+    codec = turbo_jpeg()
+    arr = None
+    if codec is not None and data[:2] == JPEG_MAGIC:
+        try:
+            arr = codec.decode(data, pixel_format=TJPF_RGB)
+        except OSError as exc:  # e.g. CMYK JPEGs libjpeg-turbo cannot map to RGB
+            LOGGER.warning("Falling back to PIL decode: %s", exc)
+    if arr is None:
+        arr = np.array(img.convert("RGB"))
+    np.bitwise_not(arr, out=arr)
+    if codec is not None:
+        return codec.encode(arr, quality=JPEG_QUALITY, pixel_format=TJPF_RGB)
     buf = io.BytesIO()
-    result.save(buf, format="JPEG")
-    buf.seek(0)
-    s3.put_object(
+    Image.fromarray(arr).save(buf, format="JPEG", quality=JPEG_QUALITY)
+    return buf.getvalue()
+
+
+def download_image(key: str) -> Optional[torch.Tensor]:
+    """Fetch and decode an upload for the device stage.
+
+    Images the host can finish on its own are inverted and uploaded right here
+    instead, and None is returned for them.
+    """
+
+    LOGGER.info("Processing image %s", key)
+    obj = s3().get_object(Bucket=UPLOAD_BUCKET, Key=key)
+    data = obj["Body"].read()
+    if INVERT_BACKEND == "yuv" and data[:2] == JPEG_MAGIC and turbo_jpeg():
+        try:
+            jpeg = invert_jpeg_yuv(data)
+        except OSError as exc:  # e.g. CMYK/YCCK or 12-bit JPEGs
+            LOGGER.warning("Falling back to RGB invert for %s: %s", key, exc)
+        else:
+            put_result(key, jpeg)
+            return None
+
+    # Opening only parses the header, so the size is known before decoding.
+    img = Image.open(io.BytesIO(data))
+    if DEVICE.type != "cuda" or img.width * img.height * 3 < CPU_INVERT_MAX_BYTES:
+        put_result(key, invert_on_host(data, img))
+        return None
+    return decode_image(data)
+
+
+def put_result(key: str, jpeg: bytes) -> None:
+    s3().put_object(
         Bucket=OUTPUT_BUCKET,
         Key=key,
-        Body=buf,
+        Body=jpeg,
         ContentType="image/jpeg",
     )
+    record_processed()
+    LOGGER.info("Completed processing %s", key)
+
+
+def upload_image(key: str, host: torch.Tensor, done: torch.cuda.Event) -> None:
+    done.synchronize()
+    encoded = encode_jpeg(host, quality=JPEG_QUALITY)
+    put_result(key, encoded.numpy().tobytes())
+
 
-    cloudwatch.put_metric_data(
+def record_processed() -> None:
+    with METRICS_LOCK:
+        METRICS["ImagesProcessed"] += 1
+
+
+def put_metrics(images: int) -> None:
+    """Report ``images`` processed images as CloudWatch statistic sets."""
+
+    cloudwatch().put_metric_data(
         Namespace="PhotoPipeline",
         MetricData=[
-            {"MetricName": "ImagesProcessed", "Value": 1, "Unit": "Count"},
+            {
+                "MetricName": "ImagesProcessed",
+                "StatisticValues": {
+                    "SampleCount": images,
+                    "Sum": images,
+                    "Minimum": 1,
+                    "Maximum": 1,
+                },
+                "Unit": "Count",
+                "StorageResolution": 60,
+            },
             {
                 "MetricName": "ProcessingCost",
-                "Value": COST_PER_IMAGE,
+                "StatisticValues": {
+                    "SampleCount": images,
+                    "Sum": images * COST_PER_IMAGE,
+                    "Minimum": COST_PER_IMAGE,
+                    "Maximum": COST_PER_IMAGE,
+                },
                 "Unit": "None",
+                "StorageResolution": 60,
             },
         ],
     )
-    LOGGER.info("Completed processing %s", key)
+
+
+def flush_metrics() -> None:
+    """Publish the metrics accumulated since the last flush, off the hot path."""
+
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        with METRICS_LOCK:
+            images = METRICS.pop("ImagesProcessed", 0)
+        if not images:
+            continue
+        try:
+            put_metrics(images)
+        except Exception as exc:  # keep the counts for the next flush
+            LOGGER.warning("Failed to publish metrics: %s", exc)
+            with METRICS_LOCK:
+                METRICS["ImagesProcessed"] += images
+
+
+def receive_stage(queue_url: str, received: queue.Queue) -> None:
+    """Keep the next SQS batches buffered while earlier ones are processed."""
+
+    while True:
+        try:
+            for messages in read_batches(queue_url):
+                received.put(messages)
+        except Exception as exc:  # LocalStack may drop the long poll
+            LOGGER.warning("Receiving messages failed, retrying: %s", exc)
+            time.sleep(1)
+
+
+def download_stage(
+    received: queue.Queue, downloaded: queue.Queue, executor: ThreadPoolExecutor
+) -> None:
+    """Start S3 downloads for every image in a batch as soon as it arrives."""
+
+    while True:
+        messages = received.get()
+        try:
+            downloads = [
+                (message, key, executor.submit(download_image, key))
+                for message in messages
+                for key in extract_keys(message)
+            ]
+        except Exception as exc:  # leave the batch for redelivery
+            LOGGER.warning("Failed to start downloads: %s", exc)
+            continue
+        downloaded.put((messages, downloads))
+
+
+def gpu_stage(
+    downloaded: queue.Queue, uploaded: queue.Queue, executor: ThreadPoolExecutor
+) -> None:
+    """Invert each downloaded batch on the device and start the uploads."""
+
+    while True:
+        messages, downloads = downloaded.get()
+        try:
+            dispatch_batch(messages, downloads, uploaded, executor)
+        except Exception as exc:  # leave the batch for redelivery
+            LOGGER.warning("Failed to process batch: %s", exc)
+
+
+def dispatch_batch(
+    messages: List[Dict[str, str]],
+    downloads: List[Tuple[Dict[str, str], str, Future]],
+    uploaded: queue.Queue,
+    executor: ThreadPoolExecutor,
+) -> None:
+    """Wait for a batch's downloads, invert them together, and queue uploads."""
+
+    failed: Set[str] = set()
+    owners: List[Tuple[Dict[str, str], str]] = []
+    images: List[torch.Tensor] = []
+    uploads: Dict[str, List[Future]] = {
+        message["MessageId"]: [] for message in messages
+    }
+    for message, key, download in downloads:
+        try:
+            image = download.result()
+        except Exception as exc:  # leave the message for redelivery
+            LOGGER.warning("Failed to process %s: %s", key, exc)
+            failed.add(message["MessageId"])
+        else:
+            if image is None:  # already inverted and uploaded on the host
+                uploads[message["MessageId"]].append(download)
+            else:
+                owners.append((message, key))
+                images.append(image)
+
+    if images:
+        results, done = process_batch(images)
+        for (message, key), result in zip(owners, results):
+            uploads[message["MessageId"]].append(
+                executor.submit(upload_image, key, result, done)
+            )
+
+    # One entry per batch, like the other stage queues, so the device stage never
+    # blocks partway through a batch waiting for the previous batch's uploads.
+    uploaded.put(
+        [
+            (message, uploads[message["MessageId"]])
+            for message in messages
+            if message["MessageId"] not in failed
+        ]
+    )
+
+
+def delete_messages(queue_url: str, entries: List[Dict[str, str]]) -> None:
+    try:
+        response = sqs().delete_message_batch(
+            QueueUrl=queue_url, Entries=entries
+        )
+    except (ClientError, BotoCoreError) as exc:  # retried after visibility timeout
+        LOGGER.warning("Failed to delete %d messages: %s", len(entries), exc)
+        return
+    for failure in response.get("Failed", []):
+        LOGGER.warning(
+            "Failed to delete message %s: %s",
+            failure["Id"],
+            failure.get("Message", failure.get("Code")),
+        )
+
+
+def delete_stage(queue_url: str, uploaded: queue.Queue) -> None:
+    """Delete each batch's messages once every upload they triggered succeeded."""
+
+    while True:
+        entries: List[Dict[str, str]] = []
+        for message, uploads in uploaded.get():
+            try:
+                for upload in uploads:
+                    upload.result()
+            except Exception as exc:  # leave the message for redelivery
+                LOGGER.warning(
+                    "Failed to process message %s: %s", message["MessageId"], exc
+                )
+            else:
+                entries.append(
+                    {
+                        "Id": message["MessageId"],
+                        "ReceiptHandle": message["ReceiptHandle"],
+                    }
+                )
+
+        if entries:
+            try:
+                delete_messages(queue_url, entries)
+            except Exception as exc:  # messages reappear after the visibility timeout
+                LOGGER.warning("Failed to delete %d messages: %s", len(entries), exc)
 
 
 def consume_events(queue_url: str) -> None:
-    for message in read_messages(queue_url):
-        message_body = message.get("Body", "")
-        records = parse_s3_records(message_body)
-        for record in records:
-            key = record.get("s3", {}).get("object", {}).get("key")
-            if not key:
-                continue
-            process_image(key)
-        receipt_handle = message["ReceiptHandle"]
-        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
+    """Run receive, download, GPU, upload, and delete as overlapping stages.
+
+    Each stage works on the batch of messages returned by one receive_message
+    call, so every batch costs a single H2D copy, kernel, and D2H copy.
+    """
+
+    received: queue.Queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    downloaded: queue.Queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    uploaded: queue.Queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    executor = ThreadPoolExecutor(max_workers=S3_MAX_WORKERS)
+
+    for target, args in (
+        (receive_stage, (queue_url, received)),
+        (download_stage, (received, downloaded, executor)),
+        (delete_stage, (queue_url, uploaded)),
+        (flush_metrics, ()),
+    ):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    gpu_stage(downloaded, uploaded, executor)
 
 
 def main() -> None:
+    if DEVICE.type != "cuda":
+        LOGGER.warning("CUDA GPU not available, inverting every image on the CPU")
     queue_url = ensure_infrastructure()
     LOGGER.info("Waiting for upload events...")
     consume_events(queue_url)
 
 
 if __name__ == "__main__":
-    #if not torch.cuda.is_available():
-    #    raise RuntimeError("CUDA GPU not available")
     main()
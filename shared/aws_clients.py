@@ -0,0 +1,118 @@
+"""boto3 clients and CloudWatch logging shared by the processor and the webapp.
+
+Clients are built lazily and cached, so each process resolves endpoints and
+credentials once and every caller shares the same HTTP connection pools.
+"""
+
+import functools
+import logging
+import os
+import sys
+from typing import Dict
+
+import boto3
+import watchtower
+from botocore.client import BaseClient
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+AWS_ENDPOINT_URL = os.environ.get("AWS_ENDPOINT_URL")
+AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
+AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
+
+# Large enough for the processor's S3 workers and the webapp's greenlets to
+# each hold a connection without queueing on the pool.
+CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+S3_CONFIG = CLIENT_CONFIG.merge(
+    Config(signature_version="s3v4", s3={"addressing_style": "path"})
+)
+
+
+def build_common_kwargs() -> Dict[str, str]:
+    """Common configuration for boto3 clients respecting LocalStack endpoints."""
+
+    kwargs: Dict[str, str] = {"region_name": AWS_REGION}
+    if AWS_ENDPOINT_URL:
+        kwargs["endpoint_url"] = AWS_ENDPOINT_URL
+    if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+        kwargs.update(
+            {
+                "aws_access_key_id": AWS_ACCESS_KEY_ID,
+                "aws_secret_access_key": AWS_SECRET_ACCESS_KEY,
+            }
+        )
+    return kwargs
+
+
+@functools.cache
+def session() -> boto3.Session:
+    return boto3.Session()
+
+
+@functools.cache
+def client(service: str) -> BaseClient:
+    config = S3_CONFIG if service == "s3" else CLIENT_CONFIG
+    return session().client(service, config=config, **build_common_kwargs())
+
+
+def s3() -> BaseClient:
+    return client("s3")
+
+
+def sqs() -> BaseClient:
+    return client("sqs")
+
+
+def sns() -> BaseClient:
+    return client("sns")
+
+
+def cloudwatch() -> BaseClient:
+    return client("cloudwatch")
+
+
+def logs() -> BaseClient:
+    return client("logs")
+
+
+def setup_logging(name: str, log_group: str, log_stream: str) -> logging.Logger:
+    """Configure application logging to send output to stdout and CloudWatch."""
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    if logger.handlers:
+        return logger
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    logger.addHandler(stream_handler)
+
+    try:
+        logs().create_log_group(logGroupName=log_group)
+    except ClientError as exc:  # group may already exist
+        error_code = exc.response.get("Error", {}).get("Code")
+        if error_code not in {"ResourceAlreadyExistsException"}:
+            logger.warning("Failed to create log group: %s", exc)
+    except Exception as exc:  # LocalStack may not be ready yet
+        logger.warning("CloudWatch logs unavailable: %s", exc)
+
+    try:
+        logger.addHandler(
+            watchtower.CloudWatchLogHandler(
+                log_group=log_group,
+                stream_name=log_stream,
+                create_log_group=False,
+                boto3_client=logs(),
+            )
+        )
+    except Exception as exc:
+        logger.warning("Falling back to stdout logging only: %s", exc)
+
+    return logger
@@ -1,25 +1,23 @@
-import json
-import logging
+import itertools
 import os
-import queue
 import threading
 import time
-from typing import Dict, Iterable, List
+import uuid
+from collections import deque
+from string import Template
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
 
-import boto3
-import watchtower
-from botocore.config import Config
+import orjson
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from flask import Flask, Response, jsonify, render_template, request
 from werkzeug.utils import secure_filename
 
+from aws_clients import AWS_ENDPOINT_URL, s3, setup_logging, sns
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "development")
 
-AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
-AWS_ENDPOINT_URL = os.environ.get("AWS_ENDPOINT_URL")
-AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
 UPLOAD_BUCKET = os.environ.get("UPLOAD_BUCKET", "uploads")
 OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET", "processed")
 PROCESSED_TOPIC_NAME = os.environ.get("PROCESSED_TOPIC_NAME", "processed-updates")
@@ -29,131 +27,158 @@ SNS_HTTP_ENDPOINT = os.environ.get(
 PUBLIC_S3_ENDPOINT = os.environ.get("PUBLIC_S3_ENDPOINT", "http://localhost:4566")
 LOG_GROUP_NAME = os.environ.get("CLOUDWATCH_LOG_GROUP", "/local/webapp")
 LOG_STREAM_NAME = os.environ.get("CLOUDWATCH_LOG_STREAM", "webapp")
+PRESIGNED_URL_EXPIRES = 3600
+# Signed URLs are reused until they have less than ten minutes left.
+PRESIGNED_URL_TTL = 3000
+EVENT_BACKLOG = 100
+SSE_KEEPALIVE_SECONDS = 15
+INDEX_REFRESH_SECONDS = 30
+
 
+# Stream uploads in 8 MiB parts so peak memory tracks the part size, not the file.
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024, max_concurrency=4
+)
 
-COMMON_KWARGS: Dict[str, str] = {"region_name": AWS_REGION}
-if AWS_ENDPOINT_URL:
-    COMMON_KWARGS["endpoint_url"] = AWS_ENDPOINT_URL
-if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-    COMMON_KWARGS.update(
+LOGGER = setup_logging("webapp", LOG_GROUP_NAME, LOG_STREAM_NAME)
+# Serialized once at import; only the topic ARN is filled in at startup.
+PROCESSED_TOPIC_POLICY = Template(
+    orjson.dumps(
         {
-            "aws_access_key_id": AWS_ACCESS_KEY_ID,
-            "aws_secret_access_key": AWS_SECRET_ACCESS_KEY,
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Sid": "AllowS3",
+                    "Effect": "Allow",
+                    "Principal": {"Service": "s3.amazonaws.com"},
+                    "Action": "SNS:Publish",
+                    "Resource": "$topic_arn",
+                    "Condition": {
+                        "ArnLike": {"aws:SourceArn": f"arn:aws:s3:::{OUTPUT_BUCKET}"}
+                    },
+                }
+            ],
         }
-    )
-
-S3_CLIENT = boto3.client(
-    "s3",
-    config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
-    **COMMON_KWARGS,
+    ).decode()
 )
-SNS_CLIENT = boto3.client("sns", **COMMON_KWARGS)
-LOGS_CLIENT = boto3.client("logs", **COMMON_KWARGS)
+# Every SSE client reads from one shared log of recent events instead of owning
+# a queue, so publishing is O(1) no matter how many browsers are connected. The
+# log doubles as the replay buffer for clients that connect or reconnect, so it
+# holds only bucket and key and each URL is signed as the event is sent.
+EVENT_LOG: Deque[Tuple[int, Dict[str, str]]] = deque(maxlen=EVENT_BACKLOG)
+EVENT_IDS = itertools.count(1)
+# Wire ids are "<boot id>-<sequence>" so a Last-Event-ID from an earlier process
+# is recognised as foreign even when its sequence number is still in range.
+BOOT_ID = uuid.uuid4().hex[:12]
+EVENTS_CONDITION = threading.Condition()
+INITIALIZED = threading.Event()
+INITIALIZER_STARTED = threading.Event()
+SIGNED_URL_CACHE: Dict[str, Tuple[str, float]] = {}
+SIGNED_URL_LOCK = threading.Lock()
+# Keys in the processed bucket, refreshed in the background and extended by SNS.
+PROCESSED_INDEX: List[str] = []
+PROCESSED_KEYS: Set[str] = set()
+# Sequence numbers order SNS notifications against bucket listings, so a re-list
+# keeps keys notified while it ran and never replaces a newer listing.
+NOTIFIED_AT: Dict[str, int] = {}
+INDEX_SEQUENCE = itertools.count(1)
+INDEX_LISTED_AT = 0
+PROCESSED_INDEX_LOCK = threading.Lock()
+PROCESSED_INDEX_LOADED = threading.Event()
 
 
-def configure_logging() -> logging.Logger:
-    logger = logging.getLogger("webapp")
-    logger.setLevel(logging.INFO)
-    if logger.handlers:
-        return logger
+def _last_event_id() -> int:
+    return EVENT_LOG[-1][0] if EVENT_LOG else 0
 
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(handler)
 
-    try:
-        LOGS_CLIENT.create_log_group(logGroupName=LOG_GROUP_NAME)
-    except ClientError as exc:
-        error_code = exc.response.get("Error", {}).get("Code")
-        if error_code not in {"ResourceAlreadyExistsException"}:
-            logger.warning("Unable to create log group: %s", exc)
-    except Exception as exc:
-        logger.warning("CloudWatch logs unavailable: %s", exc)
+def publish_event(payload: Dict[str, str]) -> None:
+    LOGGER.info("Publishing update for %s", payload.get("key"))
+    with EVENTS_CONDITION:
+        EVENT_LOG.append((next(EVENT_IDS), payload))
+        EVENTS_CONDITION.notify_all()
 
-    try:
-        logger.addHandler(
-            watchtower.CloudWatchLogHandler(
-                log_group=LOG_GROUP_NAME,
-                stream_name=LOG_STREAM_NAME,
-                create_log_group=False,
-                boto3_client=boto3.client("logs", **COMMON_KWARGS),
-            )
-        )
-    except Exception as exc:
-        logger.warning("Falling back to local logging only: %s", exc)
 
-    return logger
+def parse_last_event_id(header: str) -> int:
+    """Return the sequence number of a Last-Event-ID sent by this process, else 0."""
 
+    boot_id, _, sequence = header.partition("-")
+    if boot_id != BOOT_ID or not sequence.isdigit():
+        return 0
+    return int(sequence)
 
-LOGGER = configure_logging()
-SUBSCRIBERS: List[queue.Queue] = []
-SUBSCRIBERS_LOCK = threading.Lock()
-INITIALIZED = threading.Event()
-INITIALIZER_STARTED = threading.Event()
 
+def format_event(event_id: int, payload: Dict[str, str], replay: bool) -> str:
+    event = "event: replay\n" if replay else ""
+    message = {**payload, "url": presigned_url(payload["key"])}
+    data = orjson.dumps(message).decode()
+    return f"{event}id: {BOOT_ID}-{event_id}\ndata: {data}\n\n"
 
-def publish_event(payload: Dict[str, str]) -> None:
-    LOGGER.info("Publishing update for %s", payload.get("key"))
-    with SUBSCRIBERS_LOCK:
-        for q in list(SUBSCRIBERS):
-            q.put(payload)
 
+def _events_after(last_seen: int) -> List[Tuple[int, Dict[str, str]]]:
+    return [
+        (event_id, payload) for event_id, payload in EVENT_LOG if event_id > last_seen
+    ]
 
-def event_stream() -> Iterable[str]:
-    client_queue: "queue.Queue[Dict[str, str]]" = queue.Queue()
-    with SUBSCRIBERS_LOCK:
-        SUBSCRIBERS.append(client_queue)
-    try:
-        while True:
-            message = client_queue.get()
-            yield f"data: {json.dumps(message)}\n\n"
-    finally:
-        with SUBSCRIBERS_LOCK:
-            if client_queue in SUBSCRIBERS:
-                SUBSCRIBERS.remove(client_queue)
+
+def event_stream(last_event_id: int = 0) -> Iterable[str]:
+    """Replay buffered events newer than ``last_event_id``, then stream new ones.
+
+    A fresh client, or one whose Last-Event-ID came from an earlier process, gets
+    the last EVENT_BACKLOG events as ``replay`` events so the page can render
+    them without reporting them as new. A reconnecting client only receives what
+    it missed, as ordinary messages, and so does everything published after the
+    connect-time snapshot.
+    """
+
+    with EVENTS_CONDITION:
+        backlog = _events_after(last_event_id)
+        last_seen = _last_event_id()
+    for event_id, message in backlog:
+        yield format_event(event_id, message, replay=last_event_id == 0)
+
+    while True:
+        with EVENTS_CONDITION:
+            EVENTS_CONDITION.wait_for(
+                lambda: _last_event_id() > last_seen, timeout=SSE_KEEPALIVE_SECONDS
+            )
+            pending = _events_after(last_seen)
+            last_seen = _last_event_id()
+        if not pending:
+            # Comment lines keep proxies from closing idle streams and surface
+            # disconnected clients so their greenlets can exit.
+            yield ": keepalive\n\n"
+        for event_id, message in pending:
+            yield format_event(event_id, message, replay=False)
 
 
 def ensure_bucket(name: str) -> None:
     try:
-        S3_CLIENT.head_bucket(Bucket=name)
+        s3().head_bucket(Bucket=name)
     except ClientError:
         LOGGER.info("Creating bucket %s", name)
-        S3_CLIENT.create_bucket(Bucket=name)
+        s3().create_bucket(Bucket=name)
 
 
 def ensure_topic() -> str:
-    response = SNS_CLIENT.create_topic(Name=PROCESSED_TOPIC_NAME)
+    response = sns().create_topic(Name=PROCESSED_TOPIC_NAME)
     topic_arn = response["TopicArn"]
 
-    policy = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Sid": "AllowS3",
-                "Effect": "Allow",
-                "Principal": {"Service": "s3.amazonaws.com"},
-                "Action": "SNS:Publish",
-                "Resource": topic_arn,
-                "Condition": {
-                    "ArnLike": {"aws:SourceArn": f"arn:aws:s3:::{OUTPUT_BUCKET}"}
-                },
-            }
-        ],
-    }
-    SNS_CLIENT.set_topic_attributes(
-        TopicArn=topic_arn, AttributeName="Policy", AttributeValue=json.dumps(policy)
+    sns().set_topic_attributes(
+        TopicArn=topic_arn,
+        AttributeName="Policy",
+        AttributeValue=PROCESSED_TOPIC_POLICY.substitute(topic_arn=topic_arn),
     )
     return topic_arn
 
 
 def ensure_subscription(topic_arn: str) -> None:
-    subscriptions = SNS_CLIENT.list_subscriptions_by_topic(TopicArn=topic_arn)[
+    subscriptions = sns().list_subscriptions_by_topic(TopicArn=topic_arn)[
         "Subscriptions"
     ]
     endpoints = {sub.get("Endpoint") for sub in subscriptions}
     if SNS_HTTP_ENDPOINT in endpoints:
         return
-    SNS_CLIENT.subscribe(
+    sns().subscribe(
         TopicArn=topic_arn, Protocol="http", Endpoint=SNS_HTTP_ENDPOINT
     )
 
@@ -168,7 +193,7 @@ def ensure_processed_notifications(topic_arn: str) -> None:
             }
         ]
     }
-    S3_CLIENT.put_bucket_notification_configuration(
+    s3().put_bucket_notification_configuration(
         Bucket=OUTPUT_BUCKET, NotificationConfiguration=notification_configuration
     )
 
@@ -188,6 +213,7 @@ def initialize_async() -> None:
         try:
             ensure_resources()
             LOGGER.info("Initialization complete")
+            threading.Thread(target=refresh_processed_index, daemon=True).start()
             return
         except Exception as exc:  # LocalStack may not be ready yet
             LOGGER.warning("Initialization failed, retrying: %s", exc)
@@ -228,11 +254,14 @@ def upload() -> Response:
     filename = secure_filename(file_storage.filename)
     key = f"{int(time.time())}-{filename}"
     try:
-        S3_CLIENT.put_object(
-            Bucket=UPLOAD_BUCKET,
-            Key=key,
-            Body=file_storage.read(),
-            ContentType=file_storage.mimetype or "application/octet-stream",
+        s3().upload_fileobj(
+            file_storage.stream,
+            UPLOAD_BUCKET,
+            key,
+            ExtraArgs={
+                "ContentType": file_storage.mimetype or "application/octet-stream"
+            },
+            Config=UPLOAD_TRANSFER_CONFIG,
         )
     except Exception as exc:
         LOGGER.error("Upload failed: %s", exc)
@@ -244,10 +273,12 @@ def upload() -> Response:
 
 @app.route("/events")
 def events() -> Response:
+    last_event_id = parse_last_event_id(request.headers.get("Last-Event-ID", ""))
+
     def generate() -> Iterable[str]:
         if not INITIALIZED.is_set():
             INITIALIZED.wait()
-        yield from event_stream()
+        yield from event_stream(last_event_id)
 
     return Response(generate(), mimetype="text/event-stream")
 
@@ -258,20 +289,100 @@ def _normalize_url(url: str) -> str:
     return url.replace(AWS_ENDPOINT_URL, PUBLIC_S3_ENDPOINT)
 
 
+def _cached_url(key: str) -> Optional[str]:
+    with SIGNED_URL_LOCK:
+        cached = SIGNED_URL_CACHE.get(key)
+        if cached is None:
+            return None
+        url, expires_at = cached
+        if expires_at <= time.monotonic():
+            del SIGNED_URL_CACHE[key]
+            return None
+    return url
+
+
+def presigned_url(key: str) -> str:
+    """Return a browser-facing GET URL for a processed image, signing on miss."""
+
+    url = _cached_url(key)
+    if url is not None:
+        return url
+
+    presigned = s3().generate_presigned_url(
+        "get_object",
+        Params={"Bucket": OUTPUT_BUCKET, "Key": key},
+        ExpiresIn=PRESIGNED_URL_EXPIRES,
+    )
+    url = _normalize_url(presigned)
+    with SIGNED_URL_LOCK:
+        SIGNED_URL_CACHE[key] = (url, time.monotonic() + PRESIGNED_URL_TTL)
+    return url
+
+
+def fetch_processed_keys() -> List[str]:
+    paginator = s3().get_paginator("list_objects_v2")
+    keys: List[str] = []
+    for page in paginator.paginate(Bucket=OUTPUT_BUCKET):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+
+def load_processed_index() -> None:
+    global INDEX_LISTED_AT
+
+    with PROCESSED_INDEX_LOCK:
+        started_at = next(INDEX_SEQUENCE)
+    keys = fetch_processed_keys()
+    with PROCESSED_INDEX_LOCK:
+        # A listing that started earlier but finished later is already stale.
+        if started_at > INDEX_LISTED_AT:
+            listed = set(keys)
+            notified = [
+                key
+                for key in PROCESSED_INDEX
+                if NOTIFIED_AT.get(key, 0) > started_at and key not in listed
+            ]
+            PROCESSED_INDEX[:] = keys + notified
+            PROCESSED_KEYS.clear()
+            PROCESSED_KEYS.update(PROCESSED_INDEX)
+            for key, notified_at in list(NOTIFIED_AT.items()):
+                if notified_at < started_at:
+                    del NOTIFIED_AT[key]
+            INDEX_LISTED_AT = started_at
+    PROCESSED_INDEX_LOADED.set()
+
+
+def refresh_processed_index() -> None:
+    """Re-list the processed bucket periodically to catch missed notifications."""
+
+    while True:
+        try:
+            load_processed_index()
+        except Exception as exc:
+            LOGGER.warning("Failed to refresh processed index: %s", exc)
+        time.sleep(INDEX_REFRESH_SECONDS)
+
+
+def add_to_processed_index(key: str) -> None:
+    with PROCESSED_INDEX_LOCK:
+        NOTIFIED_AT[key] = next(INDEX_SEQUENCE)
+        if key not in PROCESSED_KEYS:
+            PROCESSED_KEYS.add(key)
+            PROCESSED_INDEX.append(key)
+
+
 def list_processed_images() -> List[Dict[str, str]]:
-    objects: List[Dict[str, str]] = []
-    try:
-        response = S3_CLIENT.list_objects_v2(Bucket=OUTPUT_BUCKET)
-    except ClientError:
-        return objects
+    if not PROCESSED_INDEX_LOADED.is_set():
+        # Only the very first page load waits on S3; later ones use the cache.
+        try:
+            load_processed_index()
+        except ClientError:
+            return []
 
-    for obj in response.get("Contents", []):
-        key = obj["Key"]
-        presigned = S3_CLIENT.generate_presigned_url(
-            "get_object", Params={"Bucket": OUTPUT_BUCKET, "Key": key}, ExpiresIn=3600
-        )
-        objects.append({"key": key, "url": _normalize_url(presigned)})
-    return objects
+    with PROCESSED_INDEX_LOCK:
+        keys = list(PROCESSED_INDEX)
+    # Signing is local HMAC work, so misses are cheap enough to sign inline.
+    return [{"key": key, "url": presigned_url(key)} for key in keys]
 
 
 @app.route("/sns/processed", methods=["POST"])
@@ -281,8 +392,8 @@ def sns_processed() -> Response:
         return ("", 400)
 
     try:
-        payload = json.loads(data)
-    except json.JSONDecodeError:
+        payload = orjson.loads(data)
+    except orjson.JSONDecodeError:
         LOGGER.warning("Received non-JSON SNS payload: %s", data)
         return ("", 400)
 
@@ -292,13 +403,13 @@ def sns_processed() -> Response:
         token = payload.get("Token")
         topic_arn = payload.get("TopicArn")
         if token and topic_arn:
-            SNS_CLIENT.confirm_subscription(TopicArn=topic_arn, Token=token)
+            sns().confirm_subscription(TopicArn=topic_arn, Token=token)
         return ("", 200)
 
     if message_type == "Notification":
         try:
-            message = json.loads(payload.get("Message", "{}"))
-        except json.JSONDecodeError:
+            message = orjson.loads(payload.get("Message", "{}"))
+        except orjson.JSONDecodeError:
             LOGGER.warning("Invalid SNS message body: %s", payload.get("Message"))
             return ("", 400)
 
@@ -308,12 +419,8 @@ def sns_processed() -> Response:
             key = s3_info.get("object", {}).get("key")
             if bucket != OUTPUT_BUCKET or not key:
                 continue
-            presigned = S3_CLIENT.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": OUTPUT_BUCKET, "Key": key},
-                ExpiresIn=3600,
-            )
-            publish_event({"bucket": bucket, "key": key, "url": _normalize_url(presigned)})
+            add_to_processed_index(key)
+            publish_event({"bucket": bucket, "key": key})
 
         return ("", 200)
 